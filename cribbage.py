@@ -6,13 +6,111 @@
 #
 
 import sys
-from collections import Counter
+from collections import Counter, namedtuple
 import itertools
 import functools
 import operator
 import re
+import contextlib
+import os
+import struct
+import time
+# argparse, json, socket and the rest are imported where they are used,
+# so scoring a hand costs no more imports than it did before the daemon,
+# stats and index options existed
 # from itertools import tee
 
+# Stats collection, off unless a collect_stats() block is active
+_ActiveStats = None
+
+class CribbageStats:
+    # wall time and call counts per phase, cache hits/misses, peak RSS
+    def __init__(self):
+        self.timings = Counter()
+        self.calls = Counter()
+        self.cache_hits = Counter()
+        self.cache_misses = Counter()
+        self.peak_rss_kb = None
+
+    def __repr__(self):
+        return "CribbageStats: {}".format(self.report())
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.timings[name] += seconds
+        self.calls[name] += 1
+
+    def cache(self, name, hit):
+        if hit:
+            self.cache_hits[name] += 1
+        else:
+            self.cache_misses[name] += 1
+
+    def record_peak_rss(self):
+        try:
+            import resource
+        except ImportError:
+            # not available on Windows, peak RSS is just not reported there
+            return
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            # macOS reports bytes, everyone else kilobytes
+            peak //= 1024
+        self.peak_rss_kb = peak
+
+    def report(self):
+        caches = {}
+        for name in sorted(set(self.cache_hits) | set(self.cache_misses)):
+            hits = self.cache_hits[name]
+            total = hits + self.cache_misses[name]
+            caches[name] = {'hits': hits, 'misses': total - hits, 'hit_rate': hits / total}
+        phases = {}
+        for name in sorted(self.calls):
+            phases[name] = {'seconds': self.timings[name], 'calls': self.calls[name]}
+        return {'phases': phases, 'caches': caches, 'peak_rss_kb': self.peak_rss_kb}
+
+    def to_json(self):
+        import json
+        return json.dumps(self.report(), indent=2)
+
+@contextlib.contextmanager
+def collect_stats(profile_path=None):
+    # collect stats for everything run inside the block
+    # if profile_path is given, also run cProfile and dump pstats data there
+    global _ActiveStats
+    previous = _ActiveStats
+    stats = CribbageStats()
+    profiler = None
+    if profile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+    _ActiveStats = stats
+    try:
+        if profiler: profiler.enable()
+        yield stats
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        _ActiveStats = previous
+        stats.record_peak_rss()
+
+def _phase(name):
+    if _ActiveStats is None:
+        return contextlib.nullcontext()
+    return _ActiveStats.phase(name)
+
+def _cache(name, hit):
+    if _ActiveStats is not None:
+        _ActiveStats.cache(name, hit)
+
 # Hand of cards is a list of 4-6 cards
 # Card is a rank and a suit, rank is 1-13
 
@@ -39,6 +137,7 @@ class Card:
 
     @classmethod
     def Deck(cls):
+        _cache('deck', cls._Deck != None)
         if cls._Deck == None:
             # build it
             cls._Deck = set()
@@ -181,6 +280,8 @@ class CribbageHandAnalyzer:
             raise ValueError('Can only score hands of length 4, given the hand: ' + str(self._hand.cards))
 
         if CribbageHandAnalyzer._Verbose: print("Hand: {}, Starter: {}, crib: {}".format(self._hand, starter, crib))
+        if _ActiveStats is not None:
+            return self.__timedScore(starter, crib, _ActiveStats)
         score = 0
         score += self.__computeFlush(starter, crib)
         if CribbageHandAnalyzer._Verbose: print("{:2} after flush".format(score))
@@ -194,6 +295,21 @@ class CribbageHandAnalyzer:
         if CribbageHandAnalyzer._Verbose: print("{:2} after nobs".format(score))
         return score
 
+    def __timedScore(self, starter, crib, stats):
+        # same as score(), timing each component, only used while collecting stats
+        components = (('flush', self.__computeFlush, (starter, crib)),
+                      ('pairs', self.__computePairs, (starter,)),
+                      ('fifteens', self.__computeFifteens, (starter,)),
+                      ('runs', self.__computeRuns, (starter,)),
+                      ('nobs', self.__computeNobs, (starter,)))
+        score = 0
+        for name, compute, args in components:
+            start = time.perf_counter()
+            score += compute(*args)
+            stats.add_time('score.' + name, time.perf_counter() - start)
+            if CribbageHandAnalyzer._Verbose: print("{:2} after {}".format(score, name))
+        return score
+
     def __computeNobs(self, starter):
         cards = self._hand.cards.copy()
         if starter:
@@ -321,7 +437,8 @@ def input_and_score_hand(cmdline):
                 istring = cmdline
 
             result = None
-            hand,starter = parse_cribbage_hand(istring)
+            with _phase('parse'):
+                hand,starter = parse_cribbage_hand(istring)
 
             if len(hand.cards) == 4:
                 # just scoring
@@ -349,68 +466,549 @@ def input_and_score_hand(cmdline):
         if cmdline != "":
             return result
         else:
-            if result: print(result)
+            if result:
+                with _phase('render'):
+                    print(result)
 
         # print "I/O error({0}): {1}".format(e.errno, e.strerror)
         #except:
         #    print("Unexpected error:", sys.exc_info()[0])
         #    sys.exit(1)
 
-def determine_best_crib(hand, own_crib=True):
+def best_keep(hand, index=None):
+    # the 4 card keep with the highest expected score (mean over all 48
+    # starters), and its score distribution
+    # with a HandStrengthIndex the distributions are looked up, not scored
     if len(hand.cards) != 6:
         raise ValueError("Expected a hand with 6 cards, got {}".format(len(hand.cards)))
-
-    deck = Card.Deck()
-    # try all combinations of 4
-    # looking for hand with highest score
     best_hand = None
-    best_high_score = 0
-    best_low_score = 0
-    best_starter_card = None
+    best_expected = None
     best_distribution = None
-    it_4_cards = itertools.combinations(hand.cards, 4)
-    for four_card_hand in it_4_cards:
+    for four_card_hand in itertools.combinations(hand.cards, 4):
         this_hand = Hand(four_card_hand)
-        this_hand_high = 0
-        this_hand_low = None
-        this_hand_scores = Counter()
-
-        hand_set = set(four_card_hand)
-        this_analyzer = CribbageHandAnalyzer(this_hand)
-        for starter_card in deck.difference(hand_set):
-            score = this_analyzer.score(starter_card)
-            this_hand_scores[score] += 1
-            if score > this_hand_high:
-                this_hand_high = score
-                this_starter_card = starter_card
-            if this_hand_low and score < this_hand_low or not this_hand_low:
-                this_hand_low = score
-
-        if this_hand_high > best_high_score:
+        distribution = keep_distribution(this_hand, index)
+        this_expected = _expected(distribution)
+        if best_expected is None or this_expected > best_expected:
             best_hand = this_hand
-            best_high_score = this_hand_high
-            best_low_score = this_hand_low
-            best_starter_card = this_starter_card
-            best_distribution = this_hand_scores
+            best_expected = this_expected
+            best_distribution = distribution
+    return (best_hand, best_distribution)
 
-    mean = sum(key * count for key, count in best_distribution.items()) / best_distribution.total()
-    print("The best possible: {} / {} with high: {}, low: {}, and mean {:3.1f}.".format(best_hand, best_starter_card, best_high_score, best_low_score, mean))
+def keep_distribution(hand, index=None):
+    # hands missing from a partial index are scored from scratch
+    strength = index.get(hand) if index is not None else None
+    if strength is None:
+        return hand_score_distribution(hand)
+    return strength.distribution
 
-    width = 80  # Adjust to desired width
-    longest_key = max(len(str(key)) for key in best_distribution)
-    graph_width = width - longest_key - 6
-    widest = best_distribution.most_common(1)[0][1]
-    scale = graph_width / float(widest)
+def _expected(distribution):
+    return sum(score * count for score, count in distribution.items()) / distribution.total()
 
-    for key, size in sorted(best_distribution.items()):
-        print('{:2}: ({:4.1f}%) {}'.format(key, (100.0*size/best_distribution.total()), int(size * scale) * '*'))
+def determine_best_crib(hand, own_crib=True):
+    if len(hand.cards) != 6:
+        raise ValueError("Expected a hand with 6 cards, got {}".format(len(hand.cards)))
+
+    with _phase('discards'):
+        best_hand, best_distribution = best_keep(hand)
+        best_high_score = max(best_distribution)
+        best_low_score = min(best_distribution)
+        # a starter giving the high score, for the printout
+        analyzer = CribbageHandAnalyzer(best_hand)
+        for best_starter_card in sorted(Card.Deck().difference(best_hand.cards)):
+            if analyzer.score(best_starter_card) == best_high_score:
+                break
+
+    with _phase('render'):
+        mean = _expected(best_distribution)
+        print("Best keep by mean: {} with mean {:3.1f}, high: {} (with {}), low: {}.".format(best_hand, mean, best_high_score, best_starter_card, best_low_score))
+
+        width = 80  # Adjust to desired width
+        longest_key = max(len(str(key)) for key in best_distribution)
+        graph_width = width - longest_key - 6
+        widest = best_distribution.most_common(1)[0][1]
+        scale = graph_width / float(widest)
+
+        for key, size in sorted(best_distribution.items()):
+            print('{:2}: ({:4.1f}%) {}'.format(key, (100.0*size/best_distribution.total()), int(size * scale) * '*'))
 
     crib = set(hand.cards).difference(set(best_hand.cards))
     return (best_hand, Hand(list(crib)))
 
 
-def main():
-    print(input_and_score_hand(" ".join(sys.argv[1:])))
+def hand_score_distribution(hand, crib=False):
+    # Counter of score -> number of starters giving that score,
+    # over the 48 cards that could be cut as the starter
+    if len(hand.cards) != 4:
+        raise ValueError("Expected a hand with 4 cards, got {}".format(len(hand.cards)))
+    analyzer = CribbageHandAnalyzer(hand)
+    distribution = Counter()
+    for starter_card in Card.Deck().difference(hand.cards):
+        distribution[analyzer.score(starter_card, crib)] += 1
+    return distribution
+
+# Hand strength index: expected score and score distribution for every
+# canonical 4 card hand, sorted by expected score.
+#
+# Scores don't depend on which suit is which, only on which cards share
+# a suit, so hands that are the same up to relabelling the suits are
+# stored once (16432 canonical hands instead of 270725) with a weight
+# counting how many real hands they stand for.
+#
+# File layout (little endian): header of magic, version, record count,
+# then one record per canonical hand, in increasing expected score:
+#   4 card bytes (card index is (rank-1)*4 + suit, suits ordered CDHS)
+#   uint16 total points over the 48 starters (expected score is total/48)
+#   uint8 weight
+#   30 uint8 counts, how many starters give a score of 0..29
+
+_SuitOrder = 'CDHS'
+_Starters = 48
+_MaxScore = 29
+
+HandStrength = namedtuple('HandStrength', ['hand', 'expected', 'distribution', 'weight'])
+
+def _card_index(card):
+    return (card.rank - 1) * 4 + _SuitOrder.index(card.suit)
+
+def _index_card(index):
+    return Card(index // 4 + 1, _SuitOrder[index % 4])
+
+def canonical_hand(hand):
+    # the smallest relabelling of the hand's suits, as a Hand
+    suits = [_SuitOrder.index(c.suit) for c in hand.cards]
+    best = None
+    for perm in itertools.permutations(range(4)):
+        key = sorted((c.rank, perm[s]) for c, s in zip(hand.cards, suits))
+        if best is None or key < best:
+            best = key
+    return Hand([Card(rank, _SuitOrder[s]) for rank, s in best])
+
+class HandStrengthIndex:
+    _Header = struct.Struct('<4sHI')
+    _Record = struct.Struct('<4BHB{}B'.format(_MaxScore + 1))
+    _Magic = b'CRIX'
+    _Version = 1
+    _Default = None
+
+    # nothing is read until the first query
+    def __init__(self, path):
+        self._path = path
+        self._data = None
+        self._totals = None
+        self._cumulative = None
+        self._positions = None
+
+    def __repr__(self):
+        return "HandStrengthIndex: {}".format(self._path)
+
+    def __len__(self):
+        self._load()
+        return len(self._totals)
+
+    @property
+    def path(self):
+        return self._path
+
+    @classmethod
+    def Default(cls):
+        # $CRIBBAGE_INDEX, or hand_strength.idx next to this file
+        if cls._Default == None:
+            path = os.environ.get('CRIBBAGE_INDEX') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hand_strength.idx')
+            cls._Default = HandStrengthIndex(path)
+        return cls._Default
+
+    def _load(self):
+        _cache('index.load', self._data is not None)
+        if self._data is not None:
+            return
+        with _phase('index.load'):
+            with open(self._path, 'rb') as f:
+                data = f.read()
+            if len(data) < HandStrengthIndex._Header.size:
+                raise ValueError("{} is not a version {} hand strength index".format(self._path, HandStrengthIndex._Version))
+            magic, version, count = HandStrengthIndex._Header.unpack_from(data)
+            if magic != HandStrengthIndex._Magic or version != HandStrengthIndex._Version:
+                raise ValueError("{} is not a version {} hand strength index".format(self._path, HandStrengthIndex._Version))
+            if len(data) != HandStrengthIndex._Header.size + count * HandStrengthIndex._Record.size:
+                raise ValueError("{} is truncated".format(self._path))
+
+            totals = []
+            cumulative = []
+            positions = {}
+            running = 0
+            for i in range(count):
+                record = self._record_at(data, i)
+                totals.append(record[4])
+                running += record[5]
+                cumulative.append(running)
+                positions[record[0:4]] = i
+            self._data = data
+            self._totals = totals
+            self._cumulative = cumulative
+            self._positions = positions
+
+    def _record_at(self, data, i):
+        return HandStrengthIndex._Record.unpack_from(data, HandStrengthIndex._Header.size + i * HandStrengthIndex._Record.size)
+
+    def _entry(self, i):
+        record = self._record_at(self._data, i)
+        hand = Hand([_index_card(c) for c in record[0:4]])
+        distribution = Counter({score: count for score, count in enumerate(record[6:]) if count})
+        return HandStrength(hand, record[4] / _Starters, distribution, record[5])
+
+    def get(self, hand):
+        # HandStrength of the canonical form of this 4 card hand, or None
+        # if the index doesn't have it
+        self._load()
+        key = tuple(_card_index(c) for c in canonical_hand(hand).cards)
+        if key not in self._positions:
+            return None
+        return self._entry(self._positions[key])
+
+    def lookup(self, hand):
+        strength = self.get(hand)
+        if strength is None:
+            raise ValueError("Hand {} is not in the index {}".format(hand, self._path))
+        return strength
+
+    def percentile_of_score(self, expected):
+        # percent of all 4 card hands with expected score at or below this one
+        import bisect
+        self._load()
+        i = bisect.bisect_right(self._totals, expected * _Starters + 1e-9)
+        if i == 0:
+            return 0.0
+        return 100.0 * self._cumulative[i - 1] / self._cumulative[-1]
+
+    def percentile(self, hand):
+        return self.percentile_of_score(self.lookup(hand).expected)
+
+    def hands_between(self, low=None, high=None):
+        # stream the hands with low <= expected score <= high, weakest first
+        import bisect
+        self._load()
+        start = 0 if low is None else bisect.bisect_left(self._totals, low * _Starters - 1e-9)
+        end = len(self._totals) if high is None else bisect.bisect_right(self._totals, high * _Starters + 1e-9)
+        for i in range(start, end):
+            yield self._entry(i)
+
+def build_hand_strength_index(path, hands=None):
+    # score every canonical 4 card hand and write the index to path
+    # hands limits the index to the canonical forms of just those hands
+    if hands is None:
+        hands = (Hand(cards) for cards in itertools.combinations(sorted(Card.Deck()), 4))
+
+    weights = Counter()
+    for hand in hands:
+        weights[tuple(_card_index(c) for c in canonical_hand(hand).cards)] += 1
+
+    records = []
+    with _phase('index.build'):
+        for key in weights:
+            distribution = hand_score_distribution(Hand([_index_card(c) for c in key]))
+            total = sum(score * count for score, count in distribution.items())
+            counts = [distribution[score] for score in range(_MaxScore + 1)]
+            records.append((total, key, weights[key], counts))
+    records.sort()
+
+    with open(path, 'wb') as f:
+        f.write(HandStrengthIndex._Header.pack(HandStrengthIndex._Magic, HandStrengthIndex._Version, len(records)))
+        for total, key, weight, counts in records:
+            f.write(HandStrengthIndex._Record.pack(*key, total, weight, *counts))
+    return HandStrengthIndex(path)
+
+
+# Discard error analysis over game logs.
+#
+# A log has one dealt hand per line, tab separated:
+#   player <TAB> the six cards dealt <TAB> the two cards thrown to the crib
+# Blank lines and lines starting with # are skipped.  Each throw is scored
+# against the keep determine_best_crib() would pick, the one with the
+# highest expected score; the loss is how many expected points (mean over
+# the starters) the player's keep gives up, so it is never negative.
+# The log is read in batches and handed to a pool of worker processes with
+# only a few batches in flight, so memory use doesn't grow with the log.
+
+_LossBucket = 0.5
+
+def _new_player_summary():
+    return {'hands': 0, 'mistakes': 0, 'total_loss': 0.0, 'histogram': Counter()}
+
+@functools.lru_cache(maxsize=None)
+def _open_index(path):
+    # one index per worker process, not one per batch
+    return HandStrengthIndex(path)
+
+def _analyze_log_lines(lines, index_path=None):
+    # summary of one batch of log lines, merged by the caller
+    import math
+    index = None
+    if index_path:
+        hits = _open_index.cache_info().hits
+        index = _open_index(index_path)
+        _cache('index.open', _open_index.cache_info().hits > hits)
+    players = {}
+    skipped = 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            player, dealt, thrown = line.split('\t')
+            hand, starter = parse_cribbage_hand(dealt.strip())
+            thrown = [Card.From_String(c) for c in re.split(' *, *| +', thrown.strip())]
+            if len(hand.cards) != 6 or len(thrown) != 2 or not set(thrown) < set(hand.cards):
+                raise ValueError("Expected six cards dealt and two of them thrown: {}".format(line))
+            keep = Hand(list(set(hand.cards).difference(thrown)))
+        except ValueError:
+            skipped += 1
+            continue
+        best_hand, best_distribution = best_keep(hand, index)
+        loss = _expected(best_distribution) - _expected(keep_distribution(keep, index))
+
+        summary = players.setdefault(player.strip(), _new_player_summary())
+        summary['hands'] += 1
+        summary['total_loss'] += loss
+        if loss > 1e-9:
+            summary['mistakes'] += 1
+        summary['histogram'][math.floor(loss / _LossBucket) * _LossBucket] += 1
+    return (players, skipped)
+
+def _merge_log_summary(totals, players, skipped):
+    for player, summary in players.items():
+        total = totals['players'].setdefault(player, _new_player_summary())
+        total['hands'] += summary['hands']
+        total['mistakes'] += summary['mistakes']
+        total['total_loss'] += summary['total_loss']
+        total['histogram'].update(summary['histogram'])
+        totals['hands'] += summary['hands']
+    totals['skipped'] += skipped
+
+def _log_summary_report(totals):
+    players = {}
+    for player, summary in sorted(totals['players'].items()):
+        players[player] = {'hands': summary['hands'],
+                           'mistakes': summary['mistakes'],
+                           'total_loss': summary['total_loss'],
+                           'mean_loss': summary['total_loss'] / summary['hands'],
+                           'histogram': {'{:.1f}'.format(k): v for k, v in sorted(summary['histogram'].items())}}
+    return {'hands': totals['hands'], 'skipped': totals['skipped'], 'players': players}
+
+def analyze_discard_log(path, jobs=None, index_path=None, summary_file=None, summary_every=100000, batch_size=1000):
+    # stream the log at path through jobs worker processes (default: one
+    # per core, 1 runs in this process) and return the summary
+    # if summary_file is given, a JSON summary line is written to it every
+    # summary_every hands, and once more at the end
+    import concurrent.futures
+    import json
+    if index_path:
+        # a missing or corrupt index fails here, not once per line in the workers
+        len(HandStrengthIndex(index_path))
+    totals = {'hands': 0, 'skipped': 0, 'players': {}}
+    last_summary = 0
+
+    def merge(result):
+        nonlocal last_summary
+        _merge_log_summary(totals, *result)
+        if summary_file and totals['hands'] - last_summary >= summary_every:
+            last_summary = totals['hands']
+            summary_file.write(json.dumps(_log_summary_report(totals)) + '\n')
+            summary_file.flush()
+
+    with _phase('log.analyze'), open(path) as log:
+        batches = iter(lambda: list(itertools.islice(log, batch_size)), [])
+        if jobs == 1:
+            for batch in batches:
+                merge(_analyze_log_lines(batch, index_path))
+        else:
+            jobs = jobs or os.cpu_count() or 1
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+                window = 2 * jobs
+                pending = []
+                for batch in batches:
+                    pending.append(pool.submit(_analyze_log_lines, batch, index_path))
+                    if len(pending) >= window:
+                        merge(pending.pop(0).result())
+                for future in pending:
+                    merge(future.result())
+
+    report = _log_summary_report(totals)
+    if summary_file:
+        summary_file.write(json.dumps(report) + '\n')
+        summary_file.flush()
+    return report
+
+
+# Daemon mode: one warm process answers queries over a Unix socket, so
+# repeated command line calls skip module setup and Deck() construction.
+# Protocol is one line of input (the cards), the reply is whatever the
+# command line would have printed, then the connection is closed.
+# The client side lives in cribbage_client.py.
+
+@functools.lru_cache(maxsize=4096)
+def _command_output(istring):
+    # everything main() would print for this input, as one string
+    import io
+    if istring == "":
+        return "Expected 4, 5, or 6 cards, found: 0\n"
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            print(input_and_score_hand(istring))
+        except SystemExit:
+            pass
+    return output.getvalue()
+
+def make_daemon(socket_path=None):
+    import socketserver
+    import stat
+    from cribbage_client import default_socket_path, is_private_dir, query_daemon
+
+    class CribbageRequestHandler(socketserver.StreamRequestHandler):
+        # the daemon answers one connection at a time, so don't let a
+        # client that never sends its line hold it up
+        timeout = 1.0
+
+        def handle(self):
+            try:
+                istring = self.rfile.readline().decode().strip()
+            except OSError:
+                # timed out, or the client went away
+                return
+            hits = _command_output.cache_info().hits
+            reply = _command_output(istring)
+            _cache('daemon.reply', _command_output.cache_info().hits > hits)
+            self.wfile.write(reply.encode())
+
+    path = socket_path
+    if path is None:
+        path = default_socket_path()
+        if not os.environ.get('CRIBBAGE_SOCKET'):
+            # clients only trust the default socket in a private directory
+            directory = os.path.dirname(path)
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            if not is_private_dir(directory):
+                raise RuntimeError("{} must be a directory only you can access".format(directory))
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise RuntimeError("{} exists and is not a socket".format(path))
+        if query_daemon("", path) is not None:
+            raise RuntimeError("A cribbage daemon is already listening on {}".format(path))
+        # stale socket left behind by a daemon that died
+        os.unlink(path)
+    # warm up before taking requests
+    Card.Deck()
+    return socketserver.UnixStreamServer(path, CribbageRequestHandler)
+
+def _terminate(signum, frame):
+    # treat kill/SIGTERM like Ctrl-C, so the socket gets cleaned up
+    raise KeyboardInterrupt
+
+def serve_daemon(socket_path=None):
+    import signal
+    server = make_daemon(socket_path)
+    previous = signal.signal(signal.SIGTERM, _terminate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        server.server_close()
+        os.unlink(server.server_address)
+
+
+def main(argv=None, use_daemon=True):
+    argv = sys.argv[1:] if argv is None else argv
+    # plain card lists go to the daemon, if one is running
+    if use_daemon:
+        from cribbage_client import forward_to_daemon
+        if forward_to_daemon(argv):
+            return
+
+    if not any(a.startswith('-') for a in argv):
+        # just cards (or nothing, for interactive input), no options to parse
+        _score_and_print(" ".join(argv))
+        return
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Score a cribbage hand, or pick the best crib throw from six cards.")
+    parser.add_argument('cards', nargs='*', help="4 cards to score, 5 with a starter, or 6 to choose a crib throw")
+    parser.add_argument('--stats', action='store_true', help="print a JSON report of phase timings, call counts, cache hit rates and peak RSS to stderr")
+    parser.add_argument('--profile', metavar='FILE', help="run under cProfile and dump pstats data to FILE")
+    parser.add_argument('--daemon', action='store_true', help="run as a daemon answering queries on a Unix socket")
+    parser.add_argument('--socket', metavar='PATH', help="daemon socket (default: $CRIBBAGE_SOCKET, else cribbage.sock in $XDG_RUNTIME_DIR or in a private per-user directory under the temp dir)")
+    parser.add_argument('--no-daemon', action='store_true', help="always run in this process, even if a daemon is listening")
+    parser.add_argument('--percentile', action='store_true', help="show the expected score of 4 cards and its percentile among all 4 card hands")
+    parser.add_argument('--build-index', metavar='FILE', nargs='?', const='', help="build the hand strength index of every canonical 4 card hand (default: $CRIBBAGE_INDEX or hand_strength.idx next to cribbage.py)")
+    parser.add_argument('--analyze-log', metavar='FILE', help="score every throw in a game log against the best keep, print a JSON summary per player")
+    parser.add_argument('--jobs', type=int, help="worker processes for --analyze-log (default: one per core)")
+    parser.add_argument('--index', metavar='FILE', help="hand strength index for --percentile and --analyze-log (default: the --build-index default, if it has been built)")
+    parser.add_argument('--summary', metavar='FILE', help="append incremental JSON summaries from --analyze-log to FILE")
+    args = parser.parse_args(argv)
+    # only the default index may be missing, that just means scoring from scratch
+    if args.index and not os.path.exists(args.index):
+        parser.error("no hand strength index at {}".format(args.index))
+
+    if not (args.stats or args.profile):
+        _run_main(args)
+        return
+
+    with collect_stats(args.profile) as stats:
+        try:
+            with _phase('total'):
+                _run_main(args)
+        finally:
+            if args.stats:
+                stats.record_peak_rss()
+                print(stats.to_json(), file=sys.stderr)
+
+def _score_and_print(cmdline):
+    result = input_and_score_hand(cmdline)
+    with _phase('render'):
+        print(result)
+
+def _run_main(args):
+    # stats from --analyze-log cover this process only, not the workers
+    index = HandStrengthIndex(args.index) if args.index else HandStrengthIndex.Default()
+
+    if args.analyze_log:
+        import json
+        # without a built default index every keep is scored from scratch
+        index_path = index.path if os.path.exists(index.path) else None
+        if args.summary:
+            with open(args.summary, 'a') as summary_file:
+                report = analyze_discard_log(args.analyze_log, args.jobs, index_path, summary_file)
+        else:
+            report = analyze_discard_log(args.analyze_log, args.jobs, index_path)
+        with _phase('render'):
+            print(json.dumps(report, indent=2))
+        return
+
+    if args.build_index is not None:
+        build_hand_strength_index(args.build_index or HandStrengthIndex.Default().path)
+        return
+
+    if args.percentile:
+        try:
+            hand,starter = parse_cribbage_hand(" ".join(args.cards))
+            if len(hand.cards) != 4 or starter:
+                raise ValueError("Expected 4 cards, found: {}".format(len(args.cards)))
+            strength = index.lookup(hand)
+            with _phase('render'):
+                print("Expected score: {:.2f}, percentile: {:.1f}".format(strength.expected, index.percentile(hand)))
+        except OSError as err:
+            print("No hand strength index at {}, build it with --build-index ({})".format(index.path, err.strerror))
+        except ValueError as err:
+            print(err)
+        return
+
+    if args.daemon:
+        serve_daemon(args.socket)
+        return
+
+    # main() already tried the daemon for plain card lists
+    _score_and_print(" ".join(args.cards))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+#
+# Thin command line client for a daemon started with `cribbage.py --daemon`
+#
+# Takes the same cards as cribbage.py, sends them to the daemon and prints
+# the reply.  Only imports what talking to the socket needs, so a call
+# costs little more than starting the interpreter.  If no daemon is
+# listening, runs cribbage.py in this process instead.
+#
+
+import os
+import stat
+import sys
+
+# seconds to wait for the daemon before running in process instead
+_Timeout = 2.0
+
+def default_socket_path():
+    # $CRIBBAGE_SOCKET, else in $XDG_RUNTIME_DIR, else in a private
+    # per-user directory under the temp dir
+    path = os.environ.get('CRIBBAGE_SOCKET')
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'cribbage.sock')
+    tmpdir = os.environ.get('TMPDIR') or '/tmp'
+    return os.path.join(tmpdir, 'cribbage-{}'.format(os.getuid()), 'cribbage.sock')
+
+def is_private_dir(path):
+    # a directory we own that nobody else can get into
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and st.st_mode & 0o077 == 0
+
+def query_daemon(istring, socket_path=None, timeout=None):
+    # returns the daemon's reply, or None if no daemon is listening or it
+    # doesn't answer within timeout seconds
+    if socket_path is None:
+        socket_path = default_socket_path()
+        # only trust the default location if nobody else could have put
+        # a socket there
+        if not os.environ.get('CRIBBAGE_SOCKET') and not is_private_dir(os.path.dirname(socket_path)):
+            return None
+    # checked first so running without a daemon doesn't pay for importing socket
+    if not os.path.exists(socket_path):
+        return None
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    chunks = []
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(_Timeout if timeout is None else timeout)
+            sock.connect(socket_path)
+            sock.sendall(istring.encode() + b'\n')
+            sock.shutdown(socket.SHUT_WR)
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+    except OSError:
+        # includes socket.timeout, a stuck daemon counts as no daemon
+        return None
+    return b''.join(chunks).decode()
+
+def forward_to_daemon(argv):
+    # answer a plain `[--socket PATH] cards...` command line from the daemon
+    # returns False if the daemon didn't answer, or argv needs the full CLI
+    socket_path = None
+    cards = list(argv)
+    if len(cards) >= 2 and cards[0] == '--socket':
+        socket_path = cards[1]
+        cards = cards[2:]
+    if not cards or any(c.startswith('-') for c in cards):
+        return False
+    reply = query_daemon(" ".join(cards), socket_path)
+    if reply is None:
+        return False
+    sys.stdout.write(reply)
+    return True
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if forward_to_daemon(argv):
+        return
+    import cribbage
+    cribbage.main(argv, use_daemon=False)
+
+if __name__ == "__main__":
+    main()
+    sys.exit(0)
@@ -1,5 +1,17 @@
 import pytest
-from cribbage import Card, Hand, CribbageHandAnalyzer, compute_hand_score, parse_cribbage_hand, determine_best_crib, input_and_score_hand
+import itertools
+import json
+import pstats
+import threading
+import os
+import signal
+import subprocess
+import sys
+import time
+import socket
+import cribbage_client
+from cribbage_client import query_daemon
+from cribbage import Card, Hand, CribbageHandAnalyzer, compute_hand_score, parse_cribbage_hand, determine_best_crib, input_and_score_hand, collect_stats, main, make_daemon, hand_score_distribution, canonical_hand, build_hand_strength_index, HandStrengthIndex, best_keep, analyze_discard_log
 
 def test_Card_bad_cards():
     with pytest.raises(ValueError) as v:
@@ -272,9 +284,11 @@ def test_determine_best_crib():
     assert(Hand.From_Strings(['AS', '2C']) == c)
     assert(Hand.From_Strings(['5S', '5C', '5H', '5D']) == h)
 
+    # 3 4 5 8 can score the most (with a 7 or a 6), but keeping the jack
+    # scores more on average
     h,c = determine_best_crib(Hand.From_Strings(['3S', '4C', '5H', '8D', 'JS', 'QC']))
-    assert(Hand.From_Strings(['JS', 'QC']) == c)
-    assert(Hand.From_Strings(['3S', '4C', '5H', '8D']) == h)
+    assert(Hand.From_Strings(['8D', 'QC']) == c)
+    assert(Hand.From_Strings(['3S', '4C', '5H', 'JS']) == h)
 
     
 def test_parse_cribbage_hand():
@@ -307,3 +321,331 @@ def test_input_and_score_hand():
     assert(input_and_score_hand('5H 2C 3C 10S JS QS') == "Keep in hand: [5H, 10S, JS, QS], throw to crib: [2C, 3C]")
     assert(input_and_score_hand('5H 2C 3C 10S JS') == 'Score: 8')
     assert(input_and_score_hand('5H 2C 3C 10S') == 'Score: 4')
+
+def test_collect_stats():
+    with collect_stats() as stats:
+        input_and_score_hand('5H 2C 3C 10S JS QS')
+    report = stats.report()
+    # 15 four card keeps, each scored against the 48 other cards, then a
+    # few more to find the best starter for the printout
+    assert(report['phases']['score.flush']['calls'] > 15 * 48)
+    assert(report['phases']['discards']['calls'] == 1)
+    assert(report['phases']['render']['calls'] == 1)
+    assert(report['phases']['parse']['calls'] == 1)
+    # one Deck() per keep scored, plus one for the printout
+    assert(report['caches']['deck']['hits'] + report['caches']['deck']['misses'] == 16)
+
+    # nothing is collected outside of the block
+    input_and_score_hand('5H 2C 3C 10S JS QS')
+    assert(stats.report()['phases']['discards']['calls'] == 1)
+
+def test_main_stats_and_profile(capsys, tmp_path):
+    profile = tmp_path / 'cribbage.pstats'
+    main(['--stats', '--profile', str(profile), '5H', '2C', '3C', '10S', 'JS'])
+    out, err = capsys.readouterr()
+    assert(out == 'Score: 8\n')
+    report = json.loads(err)
+    assert(report['phases']['total']['calls'] == 1)
+    assert(report['phases']['render']['calls'] == 1)
+    assert(report['phases']['score.runs']['calls'] == 1)
+    pstats.Stats(str(profile))
+
+    # the long running modes report too
+    log = tmp_path / 'games.log'
+    log.write_text('alice\t5H 2C 3C 10S JS QS\t2C 3C\n')
+    main(['--stats', '--analyze-log', str(log), '--jobs', '1'])
+    out, err = capsys.readouterr()
+    assert(json.loads(out)['hands'] == 1)
+    assert(json.loads(err)['phases']['log.analyze']['calls'] == 1)
+
+def test_daemon(capsys, tmp_path):
+    path = str(tmp_path / 'cribbage.sock')
+    # nothing listening yet, so run in process
+    assert(query_daemon('5H 2C 3C 10S JS', path) == None)
+    main(['--socket', path, '5H', '2C', '3C', '10S', 'JS'])
+    assert(capsys.readouterr().out == 'Score: 8\n')
+
+    server = make_daemon(path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        assert(query_daemon('5H 2C 3C 10S JS', path) == 'Score: 8\n')
+        assert(query_daemon('5H 2C 3C bad', path) == 'Unknown card `bad`\nNone\n')
+
+        # the daemon's reply is exactly what running in process prints
+        main(['--no-daemon', '5H', '2C', '3C', '10S', 'JS', 'QS'])
+        in_process = capsys.readouterr().out
+        main(['--socket', path, '5H', '2C', '3C', '10S', 'JS', 'QS'])
+        assert(capsys.readouterr().out == in_process)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+def test_hand_score_distribution():
+    distribution = hand_score_distribution(Hand.From_Strings(['5S', '5C', '5H', '5D']))
+    assert(distribution.total() == 48)
+    # the quad is 20 by itself, 8 more with a ten card starter (16 of them)
+    assert(min(distribution) == 20)
+    assert(max(distribution) == 28)
+    assert(distribution[28] == 16)
+
+def test_canonical_hand():
+    a = canonical_hand(Hand.From_Strings(['5H', '5D', 'JH', 'KS']))
+    b = canonical_hand(Hand.From_Strings(['5C', '5S', 'JC', 'KH']))
+    assert(a == b)
+    # a different suit pattern is a different hand
+    c = canonical_hand(Hand.From_Strings(['5C', '5S', 'JH', 'KH']))
+    assert(a != c)
+
+def test_hand_strength_index(tmp_path):
+    hands = [Hand.From_Strings(h) for h in (['5S', '5C', '5H', '5D'],
+                                            ['4H', '10S', 'QD', '2D'],
+                                            ['4D', '10C', 'QH', '2H'],
+                                            ['3S', '4S', '5S', 'KS'],
+                                            ['4C', '5C', '6S', '6H'])]
+    path = str(tmp_path / 'index.idx')
+    build_hand_strength_index(path, hands)
+
+    index = HandStrengthIndex(path)
+    # the two nothing hands are the same up to suits
+    assert(len(index) == 4)
+    entries = list(index.hands_between())
+    assert([e.weight for e in entries] == [2, 1, 1, 1])
+    assert(entries[-1].hand == Hand.From_Strings(['5C', '5D', '5H', '5S']))
+    expected = [e.expected for e in entries]
+    assert(expected == sorted(expected))
+
+    quads = index.lookup(Hand.From_Strings(['5S', '5C', '5H', '5D']))
+    assert(quads.distribution == hand_score_distribution(quads.hand))
+    assert(index.percentile(quads.hand) == 100.0)
+    assert(index.percentile(Hand.From_Strings(['2C', '4D', '10H', 'QC'])) == 40.0)
+    assert(index.percentile_of_score(0) == 0.0)
+
+    assert(list(index.hands_between(8)) == entries[1:])
+    assert(list(index.hands_between(8, 20)) == entries[1:3])
+
+    with pytest.raises(ValueError) as v:
+        index.lookup(Hand.From_Strings(['AS', '2C', '2D', '5H']))
+
+def test_best_keep(capsys):
+    expected = lambda d: sum(k * v for k, v in d.items()) / d.total()
+    for cards in (['5H', '2C', '3C', '10S', 'JS', 'QS'], ['3S', '4C', '5H', '8D', 'JS', 'QC'], ['3C', '4S', '6S', '9H', '10D', '10H']):
+        hand = Hand.From_Strings(cards)
+        keep, distribution = best_keep(hand)
+        h,c = determine_best_crib(hand)
+        assert(keep == h)
+        assert(distribution == hand_score_distribution(h))
+        for other in itertools.combinations(hand.cards, 4):
+            assert(expected(hand_score_distribution(Hand(other))) <= expected(distribution))
+    # best_keep is quiet, only determine_best_crib printed anything
+    out = capsys.readouterr().out
+    assert(out.count('Best keep by mean') == 3)
+
+    # 4 6 10 10 has the highest possible score (21 with a 5), but 6 9 10 10
+    # averages 6 points to its 3.67
+    keep, distribution = best_keep(Hand.From_Strings(['3C', '4S', '6S', '9H', '10D', '10H']))
+    assert(keep == Hand.From_Strings(['6S', '9H', '10D', '10H']))
+    assert(max(distribution) < max(hand_score_distribution(Hand.From_Strings(['4S', '6S', '10D', '10H']))))
+
+def test_analyze_discard_log(tmp_path):
+    log = tmp_path / 'games.log'
+    log.write_text('# player, dealt, thrown\n'
+                   'alice\t5H 2C 3C 10S JS QS\t2C 3C\n'
+                   'alice\t5H 2C 3C 10S JS QS\t5H QS\n'
+                   '\n'
+                   'bob\t5S 5C 5H 5D AS 2C\tAS 2C\n'
+                   'bob\t5S 5C 5H 5D AS 2C\tAS 5D\n'
+                   'bob\t5S 5C 5H 5D AS 2C\tKS 2C\n'
+                   'carol\t5S 5C 5H\tAS 2C\n'
+                   'dave\t3C 4S 6S 9H 10D 10H\t3C 9H\n'
+                   'dave\t3C 4S 6S 9H 10D 10H\t3C 4S\n')
+    summary = tmp_path / 'summary.jsonl'
+    with open(summary, 'w') as summary_file:
+        report = analyze_discard_log(str(log), jobs=1, summary_file=summary_file, summary_every=2, batch_size=2)
+
+    assert(report['hands'] == 6)
+    # bob threw a card he wasn't dealt, carol wasn't dealt six cards
+    assert(report['skipped'] == 2)
+    alice = report['players']['alice']
+    assert(alice['hands'] == 2)
+    assert(alice['mistakes'] == 1)
+    assert(sum(alice['histogram'].values()) == 2)
+    assert(alice['histogram']['0.0'] == 1)
+    bob = report['players']['bob']
+    assert(bob['mistakes'] == 1)
+    quads = hand_score_distribution(Hand.From_Strings(['5S', '5C', '5H', '5D']))
+    three_fives = hand_score_distribution(Hand.From_Strings(['5S', '5C', '5H', '2C']))
+    expected = lambda d: sum(k * v for k, v in d.items()) / d.total()
+    assert(bob['total_loss'] == pytest.approx(expected(quads) - expected(three_fives)))
+    # keeping for the highest possible score is still a mistake
+    dave = report['players']['dave']
+    assert(dave['mistakes'] == 1)
+    assert(dave['total_loss'] == pytest.approx(6.0 - 11 / 3))
+    for player in report['players'].values():
+        assert(min(float(k) for k in player['histogram']) >= 0)
+
+    # incremental summaries, then the final one
+    lines = summary.read_text().splitlines()
+    assert(len(lines) > 1)
+    assert(json.loads(lines[-1]) == report)
+
+    # a process pool and an index give the same answer
+    index_path = str(tmp_path / 'index.idx')
+    hands = [Hand(k) for cards in (['5H', '2C', '3C', '10S', 'JS', 'QS'], ['5S', '5C', '5H', '5D', 'AS', '2C'], ['3C', '4S', '6S', '9H', '10D', '10H'])
+             for k in itertools.combinations(Hand.From_Strings(cards).cards, 4)]
+    build_hand_strength_index(index_path, hands)
+    pooled = analyze_discard_log(str(log), jobs=2, index_path=index_path, batch_size=1)
+    assert(pooled['players'].keys() == report['players'].keys())
+    for player, summary in report['players'].items():
+        assert(pooled['players'][player]['total_loss'] == pytest.approx(summary['total_loss']))
+        assert(pooled['players'][player]['histogram'] == summary['histogram'])
+
+def test_daemon_socket_safety(tmp_path, monkeypatch):
+    # never replace something that isn't a socket
+    not_a_socket = tmp_path / 'notes.txt'
+    not_a_socket.write_text('keep me')
+    with pytest.raises(RuntimeError) as v:
+        make_daemon(str(not_a_socket))
+    assert(not_a_socket.read_text() == 'keep me')
+
+    # the default socket is only trusted in a directory nobody else can use
+    monkeypatch.delenv('CRIBBAGE_SOCKET', raising=False)
+    shared = tmp_path / 'shared'
+    shared.mkdir(mode=0o755)
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(shared))
+    server = make_daemon(str(shared / 'cribbage.sock'))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        assert(query_daemon('5H 2C 3C 10S JS', str(shared / 'cribbage.sock')) == 'Score: 8\n')
+        assert(query_daemon('5H 2C 3C 10S JS') == None)
+        os.chmod(shared, 0o700)
+        assert(query_daemon('5H 2C 3C 10S JS') == 'Score: 8\n')
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+def test_daemon_sigterm(tmp_path):
+    path = str(tmp_path / 'cribbage.sock')
+    daemon = subprocess.Popen([sys.executable, 'cribbage.py', '--daemon', '--socket', path], cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        for _ in range(100):
+            if query_daemon('5H 2C 3C 10S JS', path) != None:
+                break
+            time.sleep(0.05)
+        client = subprocess.run([sys.executable, 'cribbage_client.py', '--socket', path, '5H', '2C', '3C', '10S', 'JS'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        assert(client.stdout == 'Score: 8\n')
+    finally:
+        daemon.send_signal(signal.SIGTERM)
+        daemon.wait(timeout=10)
+    # the socket is cleaned up on a plain kill
+    assert(not os.path.exists(path))
+
+def test_client_fallback(capsys, tmp_path):
+    # nothing listening, so the client runs cribbage in process
+    cribbage_client.main(['--socket', str(tmp_path / 'none.sock'), '5H', '2C', '3C', '10S'])
+    assert(capsys.readouterr().out == 'Score: 4\n')
+
+def test_default_index(capsys, tmp_path, monkeypatch):
+    path = tmp_path / 'default.idx'
+    monkeypatch.setenv('CRIBBAGE_INDEX', str(path))
+    monkeypatch.setattr(HandStrengthIndex, '_Default', None)
+
+    main(['--percentile', '5S', '5C', '5H', '5D'])
+    assert(capsys.readouterr().out.startswith('No hand strength index at {}'.format(path)))
+
+    build_hand_strength_index(str(path), [Hand.From_Strings(['5S', '5C', '5H', '5D']),
+                                          Hand.From_Strings(['4H', '10S', 'QD', '2D'])])
+    assert(HandStrengthIndex.Default().path == str(path))
+    main(['--percentile', '5S', '5C', '5H', '5D'])
+    assert(capsys.readouterr().out == 'Expected score: 22.67, percentile: 100.0\n')
+    main(['--percentile', '5S', '5C', '5H'])
+    assert(capsys.readouterr().out == 'Expected 4, 5, or 6 cards, found: 3\n')
+
+def test_cache_stats(tmp_path):
+    path = str(tmp_path / 'cribbage.sock')
+    server = make_daemon(path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with collect_stats() as stats:
+            for _ in range(3):
+                assert(query_daemon('AH 2C 3C 4S 9S', path) == 'Score: 8\n')
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    # answered once, then from the reply cache
+    assert(stats.report()['caches']['daemon.reply'] == {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3})
+
+    index_path = str(tmp_path / 'index.idx')
+    build_hand_strength_index(index_path, [Hand.From_Strings(['5S', '5C', '5H', '5D'])])
+    index = HandStrengthIndex(index_path)
+    with collect_stats() as stats:
+        for _ in range(3):
+            index.lookup(Hand.From_Strings(['5S', '5C', '5H', '5D']))
+    assert(stats.report()['caches']['index.load'] == {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3})
+
+def test_daemon_timeouts(capsys, tmp_path, monkeypatch):
+    path = str(tmp_path / 'cribbage.sock')
+    server = make_daemon(path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        # a client that connects and never sends its line only holds the
+        # daemon up until the handler times out
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stuck:
+            stuck.connect(path)
+            assert(query_daemon('5H 2C 3C 10S JS', path) == 'Score: 8\n')
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    # something listening that never answers counts as no daemon
+    silent = str(tmp_path / 'silent.sock')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+        listener.bind(silent)
+        listener.listen(1)
+        assert(query_daemon('5H 2C 3C 10S JS', silent, timeout=0.2) == None)
+        # and the client runs in process instead of hanging
+        monkeypatch.setattr(cribbage_client, '_Timeout', 0.2)
+        cribbage_client.main(['--socket', silent, '5H', '2C', '3C', '10S', 'JS'])
+        assert(capsys.readouterr().out == 'Score: 8\n')
+
+def test_bad_index(capsys, tmp_path):
+    empty = tmp_path / 'empty.idx'
+    empty.write_bytes(b'')
+    with pytest.raises(ValueError) as v:
+        len(HandStrengthIndex(str(empty)))
+    main(['--percentile', '--index', str(empty), '5S', '5C', '5H', '5D'])
+    assert(capsys.readouterr().out == '{} is not a version 1 hand strength index\n'.format(empty))
+
+    # a mistyped --index is an error, not a silent fall back to scoring
+    with pytest.raises(SystemExit) as v:
+        main(['--analyze-log', str(tmp_path / 'games.log'), '--index', str(tmp_path / 'missing.idx')])
+    assert('no hand strength index at' in capsys.readouterr().err)
+
+def test_analyze_discard_log_partial_index(tmp_path):
+    log = tmp_path / 'games.log'
+    log.write_text('alice\t5H 2C 3C 10S JS QS\t2C 3C\n'
+                   'dave\t3C 4S 6S 9H 10D 10H\t3C 4S\n')
+    scored = analyze_discard_log(str(log), jobs=1)
+
+    # an index with only some of the keeps in it, the rest get scored
+    partial = str(tmp_path / 'partial.idx')
+    build_hand_strength_index(partial, [Hand.From_Strings(['6S', '9H', '10D', '10H'])])
+    looked_up = analyze_discard_log(str(log), jobs=1, index_path=partial)
+    assert(looked_up['hands'] == 2)
+    assert(looked_up['skipped'] == 0)
+    for player, summary in scored['players'].items():
+        assert(looked_up['players'][player]['total_loss'] == pytest.approx(summary['total_loss']))
+
+    # a corrupt index is an error, not every line skipped
+    garbage = tmp_path / 'garbage.idx'
+    garbage.write_bytes(b'not an index at all')
+    with pytest.raises(ValueError) as v:
+        analyze_discard_log(str(log), jobs=1, index_path=str(garbage))